@@ -6,16 +6,32 @@
 
 import argparse
 import os
-import glob
+import tempfile
+import time
 import zipfile
-from io import BytesIO
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from bisect import bisect_left, bisect_right
 import re
+import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import pprint
 
+# Validity start and stop timestamps at the end of an EOF filename, e.g. ..._V20230101T225942_20230103T005942.EOF
+_EOF_RE = re.compile(r'V(\d{4})(\d{2})(\d{2})T(\d{2})(\d{2})(\d{2})_(\d{4})(\d{2})(\d{2})T(\d{2})(\d{2})(\d{2})\.EOF$')
+
+# First (acquisition start) timestamp in an SLC filename; matched against the basename only
+_ACQ_RE = re.compile(rb'\d{8}T\d{6}')
+# Sentinel-1 EOF links in the orbit listing page, matched on the raw bytes to skip decoding the page
+_HREF_RE = re.compile(rb'href="(S1[AB][^"]+\.EOF)"')
+
+# Deflate level for SNAP orbit ZIPs; the fastest level still compresses EOF XML well
+_ZIP_COMPRESSLEVEL = 1
+
 # Define the logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -37,6 +53,30 @@ logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
 
+def _current_umask():
+    # os.umask can only be queried by setting it, so restore it straight away;
+    # call this before starting worker threads that create files
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+@contextmanager
+def _atomic_write(path, mode):
+    # Write to a temp file next to path and move it into place only once complete,
+    # so an interrupted download never leaves a truncated file that a rerun would skip
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.dl-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        # mkstemp creates the file as 0600; give it the mode open() would have
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
 class SentinelOrbitDownloader:
 
     def __init__(self, data_directory, orbit_pass_name, insar_processor):
@@ -44,83 +84,145 @@ class SentinelOrbitDownloader:
         self.slc_directory = os.path.join(data_directory, orbit_pass_name, "slc")
         self.orbit_files_webpage = "https://s1qc.asf.alaska.edu/aux_poeorb/"
         self.target_directory = os.path.expanduser("~/.snap/auxdata/Orbits/Sentinel-1/POEORB")
-        self.NUM_TIMESTAMPS = 2
-        self.CHUNK_DIVISOR = 4
         self.EOF_DATE_FORMAT = "%Y%m%dT%H%M%S"
         self.MAX_WORKERS = 10
         self.isce_orbits_directory = os.path.join(data_directory, orbit_pass_name,'orbits')
         self.insar_processor = insar_processor
-
-    def find_satellite_names(self):
-        zip_files = glob.glob(os.path.join(self.slc_directory, "*.zip"))
-        satellite_names = set()
-        for file in zip_files:
-            if "S1A" in file:
-                satellite_names.add("S1A")
-            if "S1B" in file:
-                satellite_names.add("S1B")
-        logger.info("Satellite names found: %s", satellite_names)
-
-        return list(satellite_names)
+        self.file_mode = 0o666 & ~_current_umask()
+        self._created_dirs = set()
+
+        # Share one pooled session so worker threads reuse keep-alive connections
+        self.session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=self.MAX_WORKERS,
+                                                   max_retries=retries))
+
+    def _scan_slcs(self):
+        # Group SLC zip files by satellite in a single directory listing
+        try:
+            with os.scandir(self.slc_directory) as it:
+                zip_entries = [e for e in it if e.is_file() and e.name.endswith('.zip')]
+        except OSError as e:
+            logger.error("Could not read the slc_directory: %s", e)
+            return {}
+        groups = {}
+        for entry in zip_entries:
+            for sat in ("S1A", "S1B"):
+                if sat in entry.name:
+                    groups.setdefault(sat, []).append(entry.path)
+        logger.info("Satellite names found: %s", set(groups))
+
+        return groups
+
+    def _ensure_dir(self, path):
+        # Many EOFs share a (satellite, year, month) directory; only create each one once per run.
+        # Threads racing on the same path are harmless because makedirs uses exist_ok=True
+        if path not in self._created_dirs:
+            os.makedirs(path, exist_ok=True)
+            self._created_dirs.add(path)
 
     def download_and_zip_snap(self, eof, acquisition_date):
         eof_url = f"{self.orbit_files_webpage}/{eof}"
-        response = requests.get(eof_url)
 
-        if response.status_code == 200:
-            # Read the file content into a BytesIO object
-            file_content = BytesIO(response.content)
+        satellite_name = eof.split('_')[0]
+        year, month = acquisition_date[:4], acquisition_date[4:6]
+        dir_path = os.path.join(self.target_directory, satellite_name, year, month)
+        zip_file_path = os.path.join(dir_path, f"{os.path.basename(eof)}.zip")
 
-            satellite_name = eof.split('_')[0]
-            year, month = acquisition_date[:4], acquisition_date[4:6]
-            dir_path = os.path.join(self.target_directory, satellite_name, year, month)
-            os.makedirs(dir_path, exist_ok=True)
-
-            zip_file_path = os.path.join(dir_path, f"{os.path.basename(eof)}.zip")
-            with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-                zf.writestr(os.path.basename(eof), file_content.read())
+        if os.path.exists(zip_file_path) and os.path.getsize(zip_file_path) > 0:
+            logger.info(f"Skipping existing ZIP file:\n {zip_file_path}")
+            return
 
-            logger.info(f"Created ZIP file:\n {zip_file_path}")
-        else:
-            logger.error(f"Failed to download {eof_url}. Status code: {response.status_code}")
-            logger.exception("Exception details:")
+        with self.session.get(eof_url, stream=True, timeout=(5, 60)) as response:
+            response.raise_for_status()
+            self._ensure_dir(dir_path)
+
+            # Stream the response body straight into the ZIP entry rather than buffering it in memory
+            # Give the entry the same timestamp, permissions and compression writestr() would
+            zinfo = zipfile.ZipInfo(os.path.basename(eof), date_time=time.localtime()[:6])
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            # ZipFile.open(zinfo, 'w') ignores the archive-level compresslevel and uses the one on the
+            # ZipInfo, which has no public setter before Python 3.13 (where it is renamed compress_level)
+            zinfo._compresslevel = _ZIP_COMPRESSLEVEL
+            zinfo.external_attr = 0o600 << 16
+            with _atomic_write(zip_file_path, self.file_mode) as f, \
+                    zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED, compresslevel=_ZIP_COMPRESSLEVEL) as zf, \
+                    zf.open(zinfo, 'w', force_zip64=False) as dest:
+                for chunk in response.iter_content(64 * 1024):
+                    dest.write(chunk)
+
+        logger.info(f"Created ZIP file:\n {zip_file_path}")
 
     def download_and_zip_isce(self, eof, acquisition_date):
         eof_url = f"{self.orbit_files_webpage}/{eof}"
-        response = requests.get(eof_url)
 
-        if response.status_code == 200:
-            # Read the file content into a BytesIO object
-            file_content = BytesIO(response.content)
-            dir_path = self.isce_orbits_directory
-            os.makedirs(dir_path, exist_ok=True)
+        dir_path = self.isce_orbits_directory
+        orbit_file_path = os.path.join(dir_path, os.path.basename(eof))
 
-            # Save the file content to a file in the local system
-            orbit_file_path = os.path.join(dir_path, os.path.basename(eof))
-            with open(orbit_file_path, 'wb') as f:
-                f.write(file_content.read())
-
-            logger.info(f"Created ZIP file:\n {orbit_file_path}")
-        else:
-            logger.error(f"Failed to download {eof_url}. Status code: {response.status_code}")
-            logger.exception("Exception details:")
+        if os.path.exists(orbit_file_path) and os.path.getsize(orbit_file_path) > 0:
+            logger.info(f"Skipping existing orbit file:\n {orbit_file_path}")
+            return
 
-    def process_filtered_eof_chunk(self, chunk, acquisition_datetimes, date_format, v):
+        with self.session.get(eof_url, stream=True, timeout=(5, 60)) as response:
+            response.raise_for_status()
+            self._ensure_dir(dir_path)
+
+            # Stream the response body straight to a file in the local system
+            with _atomic_write(orbit_file_path, self.file_mode) as f:
+                for chunk in response.iter_content(64 * 1024):
+                    f.write(chunk)
+
+        logger.info(f"Created ZIP file:\n {orbit_file_path}")
+
+    def _download_one(self, eof, acquisition_date):
+        if self.insar_processor == 'isce':
+            self.download_and_zip_isce(eof, acquisition_date)
+
+        elif self.insar_processor == 'snap':
+            self.download_and_zip_snap(eof, acquisition_date)
+
+    def _download_all(self, pairs):
+        # Threads share self.session, so requests reuse pooled keep-alive connections
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            futures = {executor.submit(self._download_one, eof, date): eof for eof, date in pairs}
+            for fut in as_completed(futures):
+                eof = futures[fut]
+                try:
+                    fut.result()
+                except requests.RequestException as e:
+                    logger.error(f"Failed to download {eof}: {e}")
+                    failed.append(eof)
+                except Exception:
+                    # Keep going so one bad file doesn't abort the rest of the batch
+                    logger.exception(f"Failed to save {eof}")
+                    failed.append(eof)
+
+        if failed:
+            logger.error("%d orbit file(s) failed to download:\n%s", len(failed), pprint.pformat(failed))
+
+        return failed
+
+    @staticmethod
+    def process_filtered_eof_chunk(chunk, acquisition_datetimes, acquisition_date_strs):
+        # acquisition_datetimes must be sorted; acquisition_date_strs holds the same dates pre-formatted
         matching_dict = {}
 
         for s in chunk:
-            timestamps = s.split('_')[-v:]
-            timestamps = [ts.lstrip('V').replace('.EOF', '') for ts in timestamps]
+            m = _EOF_RE.search(s)
+            if m is None:
+                logger.error(f"Error processing '{s}': no validity timestamps found")
+                continue
 
             try:
-                timestamp_start = datetime.strptime(timestamps[-2], date_format)
-                timestamp_end = datetime.strptime(timestamps[-1], date_format)
+                timestamp_start = datetime(*map(int, m.group(1, 2, 3, 4, 5, 6)))
+                timestamp_end = datetime(*map(int, m.group(7, 8, 9, 10, 11, 12)))
 
-                matching_dates = [acq_date for acq_date in acquisition_datetimes if
-                                 acq_date >= timestamp_start and acq_date <= timestamp_end]
+                lo = bisect_left(acquisition_datetimes, timestamp_start)
+                hi = bisect_right(acquisition_datetimes, timestamp_end)
 
-                if matching_dates:
-                    matching_dict[s] = [date.strftime("%Y%m%dT%H%M%S") for date in matching_dates]
+                if lo < hi:
+                    matching_dict[s] = acquisition_date_strs[lo:hi]
 
             except ValueError:
                 logger.exception(f"Error processing '{s}'")
@@ -128,62 +230,58 @@ class SentinelOrbitDownloader:
         return matching_dict
 
     def process_orbit_data(self):
+        # Returns True if every matched orbit file is in place, False if anything failed
+        self._created_dirs.clear()
+        groups = self._scan_slcs()
 
-        
-        satellite_names = self.find_satellite_names()
+        if not groups:
+            logger.error("No satellite names (S1A or S1B) found in the slc_directory.")
+            return False
 
-        if not satellite_names:
-            logger.exception("No satellite names (S1A or S1B) found in the slc_directory.")
-            return
+        # Fetch the EOF listing once; it is the same page for every satellite
+        try:
+            response = self.session.get(self.orbit_files_webpage, timeout=(5, 60))
+        except requests.RequestException as e:
+            logger.error("Failed to retrieve the page: %s", e)
+            return False
+        if response.status_code != 200:
+            logger.error("Failed to retrieve the page. Status code: %s", response.status_code)
+            return False
 
-        for SATELLITE_NAME in satellite_names:
+        eof_list = [m.decode('ascii') for m in _HREF_RE.findall(response.content)]
+
+        failed = []
+
+        for SATELLITE_NAME, sentinel1_slc_files in groups.items():
             # Load and preprocess acquisition dates
-            zip_files = glob.glob(os.path.join(self.slc_directory, "*.zip"))
-            sentinel1_slc_files = [file for file in zip_files if SATELLITE_NAME in file]
-            acquisition_dates = [re.search(r"(\d{8}T\d{6})", filename).group(1) for filename in sentinel1_slc_files]
+            acquisition_dates = []
+            for filename in sentinel1_slc_files:
+                m = _ACQ_RE.search(os.fsencode(os.path.basename(filename)))
+                if m is None:
+                    logger.error(f"No acquisition date found in '{filename}'")
+                    continue
+                acquisition_dates.append(m.group(0).decode('ascii'))
             acquisition_datetimes = [datetime.strptime(date, self.EOF_DATE_FORMAT) for date in acquisition_dates]
             acquisition_datetimes.sort()
+            acquisition_date_strs = [date.strftime(self.EOF_DATE_FORMAT) for date in acquisition_datetimes]
 
-            # Fetch EOF files
-            response = requests.get(self.orbit_files_webpage)
-            if response.status_code != 200:
-                logger.exception("Failed to retrieve the page. Status code:", response.status_code)
-                return
-
-            eof_list = re.findall(r'href="([^"]+)"', response.text)
             sentinel1_eof_files = [item for item in eof_list if item.startswith(SATELLITE_NAME)]
 
-            # Process EOF files in parallel
-            chunk_size = len(sentinel1_eof_files) // self.CHUNK_DIVISOR
-            with ProcessPoolExecutor() as executor:
-                chunks = [sentinel1_eof_files[i:i + chunk_size] for i in range(0, len(sentinel1_eof_files), chunk_size)]
-                results = executor.map(self.process_filtered_eof_chunk, chunks, [acquisition_datetimes] * len(chunks),
-                                        [self.EOF_DATE_FORMAT] * len(chunks), [self.NUM_TIMESTAMPS] * len(chunks))
-
-            # Collect matching EOFs and acquisition dates
-            matching_dict = {}
-            for matching_strings_chunk in results:
-                for filtered_eof, matching_dates in matching_strings_chunk.items():
-                    matching_dict.setdefault(filtered_eof, []).extend(matching_dates)
+            # Match EOF files to acquisition dates; the work is too light to be worth a process pool
+            matching_dict = self.process_filtered_eof_chunk(sentinel1_eof_files, acquisition_datetimes,
+                                                            acquisition_date_strs)
 
             # Download and zip matching EOF files
             if matching_dict:
                 logger.info("Matched orbit files with slc acquisition dates:\n%s", pprint.pformat(matching_dict))
 
-                matching_eof_files = list(matching_dict.keys())
-                matched_slc_acquisition_dates = [dates[0] for dates in matching_dict.values()]
-
-                with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
-                    for eof, acquisition_date in zip(matching_eof_files, matched_slc_acquisition_dates):
-                        if self.insar_processor == 'isce':
-                            executor.submit(self.download_and_zip_isce, eof, acquisition_date)
-
-                        elif self.insar_processor == 'snap':
-                            executor.submit(self.download_and_zip_snap, eof, acquisition_date)
+                failed.extend(self._download_all([(eof, dates[0]) for eof, dates in matching_dict.items()]))
 
             else:
                 print("No matching strings found.")
 
+        return not failed
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -210,9 +308,12 @@ def main():
     # Process orbit data
 
     logger.info('***Starting SentinelOrbitDownloader***')
-    processor.process_orbit_data()
+    succeeded = processor.process_orbit_data()
     logger.info('***Finished SentinelOrbitDownloader***\n')
 
+    if not succeeded:
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
 